@@ -1,12 +1,107 @@
-import requests
+import asyncio
+import math
+import os
+import re
+import orjson
+from datetime import timedelta
+from functools import cache
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession
+from urllib3.util.retry import Retry
+import aiohttp
+from aiohttp_client_cache import CachedSession as AsyncCachedSession, SQLiteBackend
 import networkx as nx
-import matplotlib.pyplot as plt
+import numpy as np
+import torch
 from collections import defaultdict
-import time
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import SentenceTransformer
+
+# Shared session for the ISBN/work metadata lookups, reusing the same pooled
+# connections (keep-alive) instead of a fresh handshake per request.
+# Responses are cached on disk for a week, so repeat lookups of the same
+# ISBN never leave the machine (subject searches go through the async
+# session below, which carries its own matching cache). cache_control=True
+# honors the server's ETag/Last-Modified headers: refreshing a stale entry
+# sends a conditional GET and a 304 comes back with no body to download or
+# parse.
+_SESSION = CachedSession(
+    "plotlines_cache.sqlite",
+    backend="sqlite",
+    expire_after=timedelta(days=7),
+    allowable_methods=("GET",),
+    stale_if_error=True,
+    cache_control=True,
+)
+_SESSION.cache.delete(expired=True)  # Keep the cache file from growing unbounded
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=32,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+))
+_SESSION.headers.update({"User-Agent": "PlotLines/1.0", "Accept-Encoding": "gzip"})
+
+_ONNX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "miniLM-int8")
+
+
+def export_quantized_encoder():
+    """
+    One-time export: convert MiniLM to ONNX and quantize to dynamic INT8.
 
-# Load embedding model
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+    Shrinks the weights ~4x (~90 MB -> ~25 MB) and roughly 2-3x faster
+    encode() on CPU. Needs the optional optimum[onnxruntime] extra; once the
+    miniLM-int8 directory exists, _model() picks it up automatically.
+    """
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    fp32_dir = _ONNX_DIR + "-fp32"
+    ORTModelForFeatureExtraction.from_pretrained(
+        'sentence-transformers/all-MiniLM-L6-v2', export=True).save_pretrained(fp32_dir)
+    ORTQuantizer.from_pretrained(fp32_dir).quantize(
+        save_dir=_ONNX_DIR,
+        quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False))
+
+
+class _OnnxEncoder:
+    """Drop-in for SentenceTransformer.encode backed by the INT8 ONNX model."""
+
+    def __init__(self, model_dir):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_dir)
+
+    def encode(self, sentences, convert_to_tensor=False, batch_size=32, normalize_embeddings=False):
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        chunks = []
+        for i in range(0, len(sentences), batch_size):
+            inputs = self.tokenizer(sentences[i:i + batch_size], padding=True,
+                                    truncation=True, return_tensors="pt")
+            token_embs = self.model(**inputs).last_hidden_state
+            # Mean-pool over real tokens, same as the sentence-transformers head
+            mask = inputs["attention_mask"].unsqueeze(-1).float()
+            chunks.append((token_embs * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9))
+        embs = torch.cat(chunks)
+        if normalize_embeddings:
+            embs = torch.nn.functional.normalize(embs, dim=1)
+        if single:
+            embs = embs[0]
+        return embs if convert_to_tensor else embs.numpy()
+
+
+# Load embedding model lazily: only needed when a book's raw subjects
+# actually have to be encoded, and loading it costs ~1-2s and ~90 MB.
+# Prefers the quantized ONNX export when it has been built.
+@cache
+def _model():
+    if os.path.isdir(_ONNX_DIR):
+        try:
+            return _OnnxEncoder(_ONNX_DIR)
+        except Exception:
+            pass  # optimum/onnxruntime not installed (or export broken); use FP32
+    return SentenceTransformer('all-MiniLM-L6-v2')
 
 # Broad, reusable theme vocabulary (concise, portable)
 good_themes = [
@@ -38,13 +133,41 @@ good_themes = [
     # life / death
     "death", "mortality", "illness", "mourning",
 ]
-good_theme_embeddings = embedding_model.encode(good_themes, convert_to_tensor=True)
+# good_themes is a constant baked into the source, so its embedding matrix
+# is serialized once and memory-mapped on later imports instead of re-encoded
+_THEMES_NPY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "themes.npy")
+if not os.path.exists(_THEMES_NPY):
+    np.save(_THEMES_NPY, _model().encode(good_themes, normalize_embeddings=True))
+# .copy() detaches from the read-only mmap (torch warns on non-writable
+# arrays); the matrix is ~100x384 floats, so the copy is trivial
+good_theme_embeddings = torch.from_numpy(np.load(_THEMES_NPY, mmap_mode="r").copy())
 
 
 # Blocklist of overly broad subjects
 blocklist = {"fiction", "literature", "novel", "story", "books and reading", "english fiction", "american fiction"}
 
-def get_book_data_from_isbn(isbn, country_keywords):
+# Country/era keywords, matched against every raw subject; one compiled
+# alternation scans each tag once instead of N substring checks
+COUNTRY_KEYWORDS = [
+    "Japan", "Canada", "United States", "England", "France",
+    "Germany", "China", "India", "Mexico", "Italy", "Russia", "Korea"
+]
+_COUNTRY_RE = re.compile("|".join(re.escape(c) for c in COUNTRY_KEYWORDS), re.IGNORECASE)
+
+# Popular subjects ("love", "war", "coming of age", ...) recur across books;
+# remember each tag's best theme similarity so repeats skip the transformer
+_tag_sim_cache = {}
+
+
+def _clean(t):
+    """Normalize a title for dedup: lowercase and strip punctuation, so
+    "F. Scott Fitzgerald" and "F Scott Fitzgerald" collapse to one key."""
+    cleaned = re.sub(r"[^a-z0-9 ]", "", t.lower()).strip()
+    # Non-Latin titles (Japanese, Cyrillic, ...) strip to nothing and would
+    # all collide on ""; fall back to the plain lowercased string for them
+    return cleaned or t.lower().strip()
+
+def get_book_data_from_isbn(isbn):
     """
     Look up a book by ISBN on Open Library and derive up to 5 usable tags.
 
@@ -56,115 +179,144 @@ def get_book_data_from_isbn(isbn, country_keywords):
     """
     base = "https://openlibrary.org"
 
-    # --- Fetch edition by ISBN ---
-    try:
-        r = requests.get(f"{base}/isbn/{isbn}.json", timeout=20)
-    except Exception:
-        print("Network error while fetching ISBN.")
-        return None, [], "", False
-    if r.status_code != 200:
-        print("ISBN not found.")
-        return None, [], "", False
-
-    book_data = r.json()
-    title = (book_data.get("title") or f"Unknown Title ({isbn})").strip()
-
-    # --- Resolve to work key ---
-    works = book_data.get("works", [])
-    if not works:
-        return title, [], title.lower(), False
-    work_key = works[0].get("key")
-    if not work_key:
-        return title, [], title.lower(), False
-
-    # --- Fetch work (subjects live here) ---
+    # --- Try the bibkeys endpoint first: title + subjects in one response
+    # instead of the edition -> work two-hop (saves a full round-trip) ---
+    title = None
+    raw_subjects = []
+    bibkey = f"ISBN:{isbn}"
     try:
-        wr = requests.get(f"{base}{work_key}.json", timeout=20)
+        r = _SESSION.get(f"{base}/api/books",
+                         params={"bibkeys": bibkey, "jscmd": "data", "format": "json"},
+                         timeout=20)
+        if r.status_code == 200:
+            entry = orjson.loads(r.content).get(bibkey, {})
+            title = (entry.get("title") or "").strip() or None
+            raw_subjects = [s.get("name") for s in entry.get("subjects", []) if s.get("name")]
     except Exception:
-        print("Network error while fetching work record.")
-        return title, [], title.lower(), False
-    if wr.status_code != 200:
-        return title, [], title.lower(), False
-
-    work_data = wr.json()
-    raw_subjects = work_data.get("subjects", []) or []
-
-    # --- Collect country/era/place flavored tags (we ensure these get a chance) ---
-    country_tags = []
-    for tag in raw_subjects:
-        tag_lower = tag.lower().strip()
-        if any(country.lower() in tag_lower for country in country_keywords):
-            country_tags.append(tag)
-
-    # --- Semantic filter against the expanded theme bank ---
-    # Accept a subject if its max similarity to any good theme >= 0.50
-    filtered_subjects = []
-    similarity_threshold = 0.50
-    for tag in raw_subjects:
-        tag_lower = tag.lower().strip()
+        pass
 
-        # Skip obvious junk up front
-        if tag_lower in blocklist:
-            continue
+    # --- Fallback: fetch the edition, then the work (subjects live there) ---
+    if not raw_subjects:
+        try:
+            r = _SESSION.get(f"{base}/isbn/{isbn}.json", timeout=20)
+        except Exception:
+            print("Network error while fetching ISBN.")
+            return title, [], (title or "").lower(), False
+        if r.status_code != 200:
+            if title:
+                return title, [], title.lower(), False
+            print("ISBN not found.")
+            return None, [], "", False
+
+        book_data = orjson.loads(r.content)
+        title = (book_data.get("title") or title or f"Unknown Title ({isbn})").strip()
+
+        work_key = None
+        works = book_data.get("works", [])
+        if works:
+            work_key = works[0].get("key")
+        if not work_key:
+            return title, [], title.lower(), False
 
         try:
-            tag_emb = embedding_model.encode(tag, convert_to_tensor=True)
-            scores = util.cos_sim(tag_emb, good_theme_embeddings)
-            max_sim = scores.max().item()
+            wr = _SESSION.get(f"{base}{work_key}.json", timeout=20)
         except Exception:
-            # If encoding fails for any reason, skip semantic test for this tag
-            max_sim = 0.0
+            print("Network error while fetching work record.")
+            return title, [], title.lower(), False
+        if wr.status_code != 200:
+            return title, [], title.lower(), False
 
-        if max_sim >= similarity_threshold:
-            filtered_subjects.append(tag)
+        work_data = orjson.loads(wr.content)
+        raw_subjects = work_data.get("subjects", []) or []
 
-    # --- Build final tag list with backfill to reach up to 5 ---
-    # Start with semantically accepted + country/era (dedup, preserve order)
-    final_tags = []
-    seen = set()
-    for t in filtered_subjects + country_tags:
-        tl = t.lower().strip()
-        if tl not in seen:
-            final_tags.append(t)
-            seen.add(tl)
-        if len(final_tags) >= 5:
-            break
+    if not title:
+        title = f"Unknown Title ({isbn})"
 
-    # Backfill with remaining non-blocklisted raw subjects if needed
-    if len(final_tags) < 5:
-        for t in raw_subjects:
-            tl = t.lower().strip()
-            if tl in seen or tl in blocklist:
-                continue
-            final_tags.append(t)
-            seen.add(tl)
-            if len(final_tags) >= 5:
-                break
-
-    # Allow any leftover raw subjects (even if blocklisted) to avoid an empty graph
-    if len(final_tags) < 5:
-        for t in raw_subjects:
-            tl = t.lower().strip()
-            if tl in seen:
-                continue
-            final_tags.append(t)
-            seen.add(tl)
-            if len(final_tags) >= 5:
-                break
+    # --- Score any tags we haven't seen before (one batched forward pass) ---
+    similarity_threshold = 0.50
+    tag_lowers = [t.lower().strip() for t in raw_subjects]
+    misses, seen_miss = [], set()
+    for tag, tl in zip(raw_subjects, tag_lowers):
+        if tl not in blocklist and tl not in _tag_sim_cache and tl not in seen_miss:
+            misses.append(tag)
+            seen_miss.add(tl)
+
+    if misses:
+        # inference_mode skips autograd bookkeeping, and pulling the scores
+        # across with one .cpu() call avoids a host/device sync per tag
+        with torch.inference_mode():
+            tag_embs = _model().encode(misses, convert_to_tensor=True,
+                                       batch_size=64, normalize_embeddings=True)
+            # Both sides are L2-normalized, so a dot product is the cosine
+            # similarity; the theme matrix lives on CPU, so bring it over to
+            # wherever the model put the embeddings (CUDA/MPS included)
+            themes = good_theme_embeddings.to(tag_embs.device)
+            max_sims = (tag_embs @ themes.T).amax(dim=1).cpu().numpy()
+        for tag, max_sim in zip(misses, max_sims):
+            _tag_sim_cache[tag.lower().strip()] = float(max_sim)
+
+    # --- Classify every tag in a single pass: semantic hit (sim >= 0.50),
+    # country/era, backfill candidate, or junk (blocklisted, last resort
+    # only so the graph is never empty) ---
+    semantic, country, backfill, junk = [], [], [], []
+    seen = set()
+    for tag, tl in zip(raw_subjects, tag_lowers):
+        if tl in seen:
+            continue
+        seen.add(tl)
+        if tl not in blocklist and _tag_sim_cache[tl] >= similarity_threshold:
+            semantic.append(tag)
+        elif _COUNTRY_RE.search(tag):
+            country.append(tag)
+        elif tl not in blocklist:
+            backfill.append(tag)
+        else:
+            junk.append(tag)
+
+    final_tags = (semantic + country + backfill + junk)[:5]
 
     # --- Fiction heuristic ---
     subject_str = " ".join(raw_subjects).lower()
     is_fiction = ("fiction" in subject_str) and ("nonfiction" not in subject_str)
 
-    return title, final_tags[:5], title.lower(), is_fiction
+    return title, final_tags, title.lower(), is_fiction
 
 
 
-def find_books_by_subject(subject, original_title_lower, is_fiction_input, max_books=3):
+async def _fetch_subject(session, subject, original_title_lower, is_fiction_input, sem, max_books=3):
+    """Fetch related books for one subject; runs concurrently with the other tags."""
     results = []
     seen_titles = set()
+    original_clean = _clean(original_title_lower)
+
+    # 1) Curated subject endpoint: returns ranked works for the subject in
+    # one request, no search scoring needed
+    subject_url = f"https://openlibrary.org/subjects/{subject.lower().replace(' ', '_')}.json"
+    try:
+        async with sem:
+            async with session.get(subject_url, params={"limit": max_books + 2}) as response:
+                works = orjson.loads(await response.read()).get("works", []) if response.status == 200 else []
+    except Exception:
+        works = []
+
+    for work in works:
+        title = (work.get("title") or "").strip()
+        if not title:
+            continue
+        tl = _clean(title)
+        if tl == original_clean or tl in seen_titles:
+            continue
+        authors = work.get("authors") or []
+        author = (authors[0].get("name") if authors else None) or "Unknown"
+        results.append(f"{title} by {author}")
+        seen_titles.add(tl)
+        if len(results) >= max_books:
+            break
 
-    # 1) Try subject search (precise if OL knows the subject)
+    if results:
+        return results[:max_books]
+
+    # 2) Fall back to the search API when OL has no curated works for the tag
     base = "https://openlibrary.org/search.json"
     urls = [
         f"{base}?subject={subject.replace(' ', '%20')}&limit={max_books + 12}",
@@ -173,10 +325,11 @@ def find_books_by_subject(subject, original_title_lower, is_fiction_input, max_b
 
     for query in urls:
         try:
-            response = requests.get(query, timeout=20)
-            if response.status_code != 200:
-                continue
-            data = response.json()
+            async with sem:
+                async with session.get(query) as response:
+                    if response.status != 200:
+                        continue
+                    data = orjson.loads(await response.read())
         except Exception:
             continue
 
@@ -185,8 +338,8 @@ def find_books_by_subject(subject, original_title_lower, is_fiction_input, max_b
             if not title:
                 continue
 
-            tl = title.lower()
-            if tl == original_title_lower:
+            tl = _clean(title)
+            if tl == original_clean:
                 continue
             if tl in seen_titles:
                 continue
@@ -213,19 +366,33 @@ def find_books_by_subject(subject, original_title_lower, is_fiction_input, max_b
         if len(results) >= max_books:
             break
 
-        time.sleep(0.3)
-
     return results[:max_books]
 
 
+async def _gather_subjects(main_tags, original_title_lower, is_fiction_input):
+    """Look up every tag concurrently; the semaphore keeps us polite to the API."""
+    sem = asyncio.Semaphore(4)
+    timeout = aiohttp.ClientTimeout(total=20)
+    connector = aiohttp.TCPConnector(limit=8, limit_per_host=4)
+    # Subject lookups are the bulk of the traffic and bypass _SESSION, so the
+    # async session gets its own disk cache with the same expiry and
+    # ETag-based revalidation as the metadata one
+    cache = SQLiteBackend("plotlines_aiohttp_cache.sqlite",
+                          expire_after=timedelta(days=7),
+                          allowed_methods=("GET",),
+                          cache_control=True)
+    async with AsyncCachedSession(cache=cache, connector=connector, timeout=timeout,
+                                  headers={"User-Agent": "PlotLines/1.0"}) as session:
+        return await asyncio.gather(
+            *[_fetch_subject(session, tag, original_title_lower, is_fiction_input, sem)
+              for tag in main_tags]
+        )
+
+
 
 # ---------- Build Graph from ISBN ----------
 def build_similarity_graph(isbn):
-    country_keywords = [
-        "Japan", "Canada", "United States", "England", "France",
-        "Germany", "China", "India", "Mexico", "Italy", "Russia", "Korea"
-    ]
-    main_title, main_tags, original_title_lower, is_fiction = get_book_data_from_isbn(isbn, country_keywords)
+    main_title, main_tags, original_title_lower, is_fiction = get_book_data_from_isbn(isbn)
     if not main_title:
         return None, ""
 
@@ -236,28 +403,67 @@ def build_similarity_graph(isbn):
         G.add_node(tag, type="theme")
         G.add_edge(main_title, tag)
 
+    # Dedup on normalized labels so near-identical "Title by Author" strings
+    # (punctuation/case variants) don't land as separate nodes
     seen_books = set()
-    seen_books.add(main_title)
+    seen_books.add(_clean(main_title))
 
-    for tag in main_tags:
-        related_books = find_books_by_subject(tag, original_title_lower, is_fiction)
-        time.sleep(0.5)  # Limit usage
+    all_related = asyncio.run(_gather_subjects(main_tags, original_title_lower, is_fiction))
 
+    for tag, related_books in zip(main_tags, all_related):
         for book in related_books:
-            if book not in seen_books:
+            if _clean(book) not in seen_books:
                 G.add_node(book, type="book")
                 G.add_edge(book, tag)
-                seen_books.add(book)
+                seen_books.add(_clean(book))
 
     return G, main_title
 
 # ---------- Draw the Graph ----------
+def _radial_layout(G, center_title):
+    """
+    O(N) layout for the graph's known star-of-stars shape: center book in
+    the middle, themes on a unit circle around it, each theme's books on a
+    short arc just outside that theme. Returns None when the graph doesn't
+    match that shape, so the caller can fall back to a physics layout.
+    """
+    if center_title not in G:
+        return None
+    themes = [n for n in G.neighbors(center_title) if G.nodes[n].get("type") == "theme"]
+    if not themes or len(themes) != G.degree(center_title):
+        return None
+
+    pos = {center_title: (0.0, 0.0)}
+    for i, theme in enumerate(themes):
+        angle = 2 * math.pi * i / len(themes)
+        pos[theme] = (math.cos(angle), math.sin(angle))
+        books = [n for n in G.neighbors(theme) if n != center_title]
+        for j, book in enumerate(books):
+            if book in pos:  # book shared between themes: not a pure star
+                return None
+            # Fan the books over a short arc centered on the theme's angle
+            offset = (j - (len(books) - 1) / 2) * (0.5 / max(len(books), 1))
+            pos[book] = (1.7 * math.cos(angle + offset), 1.7 * math.sin(angle + offset))
+
+    if len(pos) != G.number_of_nodes():
+        return None
+    return pos
+
+
 def draw_graph(G, center_title):
-    node_colors = ["skyblue" if G.nodes[n]["type"] == "book" else "lightgreen" for n in G.nodes()]
-    node_sizes = [900 if n == center_title else 700 if G.nodes[n]["type"] == "book" else 500 for n in G.nodes()]
+    # Imported here so consumers that only build the graph (e.g. JSON
+    # export) skip matplotlib's ~200ms / ~40MB import cost
+    import matplotlib.pyplot as plt
+
+    # One traversal fills both lists and reads each node's type only once
+    node_colors, node_sizes = [], []
+    for n in G.nodes():
+        node_type = G.nodes[n]["type"]
+        node_colors.append("skyblue" if node_type == "book" else "lightgreen")
+        node_sizes.append(900 if n == center_title else 700 if node_type == "book" else 500)
     
     plt.figure(figsize=(14, 10))
-    pos = nx.spring_layout(G, seed=42)
+    pos = _radial_layout(G, center_title) or nx.spring_layout(G, seed=42)
     nx.draw(G, pos, with_labels=True, node_color=node_colors, node_size=node_sizes,
             edge_color="gray", font_size=9)
     plt.title(f"Thematic Similarity Network: {center_title}")